@@ -8,13 +8,74 @@ Returns:
 """
 import base64
 import datetime
-import hashlib
+import functools
 import hmac
 import json
-import sys
-from typing import Dict
+import time
+import uuid
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from email.utils import formatdate
+from threading import Event
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+
+def _json_default(obj):
+    """Serializes the types orjson supports natively the same way it does"""
+    if isinstance(obj, datetime.datetime) and obj.tzinfo is None:
+        obj = obj.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(
+        obj, separators=(",", ":"), ensure_ascii=False, default=_json_default
+    ).encode()
+
+
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(
+                obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+            )
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits, which json serializes
+            return _json_dumps(obj)
+
+except ImportError:
+    _dumps = _json_dumps
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 BASE_REQUEST_URI = "https://{}.ods.opinsights.azure.com/{}?api-version={}"
 DEFAULT_RESOURCE = "/api/logs"
@@ -22,6 +83,152 @@ DEFAULT_API_VERSION = "2016-04-01"
 DEFAULT_CONTENT_TYPE = "application/json"
 DEFAULT_TIMEOUT = 30
 DEFAULT_MAX_BATCH_SIZE = 29000000
+DEFAULT_MAX_PARALLEL = 4
+DEFAULT_COMPRESS_LEVEL = 1
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_FACTOR = 0.5
+# Statuses where the batch was not ingested, so posting it again cannot duplicate rows
+RETRY_STATUS_CODES = (429, 503)
+SIGNATURE_CACHE_SIZE = 8
+
+
+def _find_boundaries_py(sizes: List[int], max_size: int) -> List[int]:
+    """Greedily splits rows so each batch's total size stays within max_size.
+    A row larger than max_size gets a batch of its own.
+
+    Args:
+        sizes (list): size of each row
+        max_size (int): maximum total size of a batch
+
+    Returns:
+        list: row indices where each batch starts, followed by the row count
+    """
+    boundaries = [0]
+    batch_size = 0
+
+    for i, size in enumerate(sizes):
+        if i != boundaries[-1] and batch_size + size > max_size:
+            boundaries.append(i)
+            batch_size = 0
+        batch_size += size
+
+    if len(sizes) != boundaries[-1]:
+        boundaries.append(len(sizes))
+
+    return boundaries
+
+
+def _find_boundaries_np(sizes: List[int], max_size: int) -> List[int]:
+    """NumPy version of _find_boundaries_py, searching the cumulative sizes
+    for the end of each batch instead of walking every row.
+    """
+    cumulative = np.cumsum(np.asarray(sizes, dtype=np.int64))
+    boundaries = [0]
+    start = 0
+
+    while start < len(sizes):
+        offset = cumulative[start - 1] if start else 0
+        end = int(np.searchsorted(cumulative, offset + max_size, side="right"))
+        start = max(end, start + 1)
+        boundaries.append(start)
+
+    return boundaries
+
+
+def _find_boundaries_kernel(sizes, max_size: int):
+    """Loop of _find_boundaries_py over a NumPy int64 array, compiled with Numba"""
+    boundaries = np.empty(len(sizes) + 1, np.int64)
+    boundaries[0] = 0
+    count = 1
+    batch_size = 0
+
+    for i in range(len(sizes)):
+        if i != boundaries[count - 1] and batch_size + sizes[i] > max_size:
+            boundaries[count] = i
+            count += 1
+            batch_size = 0
+        batch_size += sizes[i]
+
+    if len(sizes) != boundaries[count - 1]:
+        boundaries[count] = len(sizes)
+        count += 1
+
+    return boundaries[:count]
+
+
+_compiled_kernel = None
+
+
+def _find_boundaries_numba(sizes: List[int], max_size: int) -> List[int]:
+    """Numba version of _find_boundaries_py, running the row loop natively.
+    Numba is imported and the kernel compiled on the first call.
+    """
+    global _compiled_kernel
+    if _compiled_kernel is None:
+        import numba
+
+        _compiled_kernel = numba.njit(_find_boundaries_kernel)
+    return _compiled_kernel(np.asarray(sizes, dtype=np.int64), max_size).tolist()
+
+
+_find_boundaries_impl = None
+
+
+def _find_boundaries(sizes: List[int], max_size: int) -> List[int]:
+    """Splits rows into batches with the fastest implementation installed,
+    chosen on first use so importing the module never loads Numba.
+    """
+    global _find_boundaries_impl
+    if _find_boundaries_impl is None:
+        if np is None:
+            _find_boundaries_impl = _find_boundaries_py
+        else:
+            try:
+                # Compiles the kernel now, so a missing or broken Numba install
+                # (e.g. built for another NumPy) falls back to NumPy
+                _find_boundaries_numba([1], 1)
+                _find_boundaries_impl = _find_boundaries_numba
+            except Exception:
+                _find_boundaries_impl = _find_boundaries_np
+    return _find_boundaries_impl(sizes, max_size)
+
+
+def _sign(
+    hmac_template,
+    sig_prefix: bytes,
+    sig_mid: bytes,
+    sig_suffix: bytes,
+    auth_prefix: bytes,
+    content_length: int,
+    x_ms_date_str: str,
+) -> bytes:
+    """Computes the SharedKey authorization value for a request
+
+    Args:
+        hmac_template (HMAC): HMAC-SHA256 keyed with the decoded shared key
+        sig_prefix (bytes): string to sign before the content length
+        sig_mid (bytes): string to sign between content length and date
+        sig_suffix (bytes): string to sign after the date
+        auth_prefix (bytes): "SharedKey <customer_id>:"
+        content_length (int): length of data to be uploaded
+        x_ms_date_str (str): formatted request date
+
+    Returns:
+        bytes: authorization header value
+    """
+    bytes_to_hash = b"".join(
+        (
+            sig_prefix,
+            str(content_length).encode(),
+            sig_mid,
+            x_ms_date_str.encode(),
+            sig_suffix,
+        )
+    )
+    signature = hmac_template.copy()
+    signature.update(bytes_to_hash)
+
+    return auth_prefix + base64.b64encode(signature.digest())
 
 
 class DataCollectorError(Exception):
@@ -41,81 +248,183 @@ class DataCollectorClient:
     ):
         self.customer_id = customer_id
         self.shared_key = shared_key
+        self._hmac_key = base64.b64decode(shared_key)
+        self._hmac_template = hmac.new(self._hmac_key, digestmod="sha256")
         self.request_uri = BASE_REQUEST_URI.format(
             self.customer_id, DEFAULT_RESOURCE, DEFAULT_API_VERSION
         )
 
         self._timeout: int = DEFAULT_TIMEOUT
         self._max_batch_size: int = DEFAULT_MAX_BATCH_SIZE
+        self._max_parallel: int = DEFAULT_MAX_PARALLEL
+        self._compress: bool = False
+        self._http2: bool = False
         self._proxies: Dict[str, str] = {}
 
+        # Invariant parts of the string to sign, around content length and date
+        self._sig_prefix = b"POST\n"
+        self._sig_mid = f"\n{DEFAULT_CONTENT_TYPE}\nx-ms-date:".encode()
+        self._sig_suffix = f"\n{DEFAULT_RESOURCE}".encode()
+        self._customer_id_bytes = customer_id.encode("ascii")
+        self._auth_prefix = b"SharedKey " + self._customer_id_bytes + b":"
+        self._log_type_cache: Dict[str, bytes] = {}
+        # Equal sized batches signed within the same second share a signature.
+        # The cache is built over the signing values, not self, so the client
+        # holds no reference cycle through it.
+        self.__sign_cached = functools.lru_cache(maxsize=SIGNATURE_CACHE_SIZE)(
+            functools.partial(
+                _sign,
+                self._hmac_template,
+                self._sig_prefix,
+                self._sig_mid,
+                self._sig_suffix,
+                self._auth_prefix,
+            )
+        )
+        self._xmsdate_cache: Tuple[int, str] = (0, "")
+
+        # Long-lived session so connections are reused across post_data calls
+        self._session = Session()
+        self._session.headers.update({"content-type": DEFAULT_CONTENT_TYPE})
+        self.__mount_adapter()
+        self._http2_client = None
+
+    def __enter__(self) -> "DataCollectorClient":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the underlying HTTP session and its pooled connections"""
+        self._session.close()
+        self.__close_http2_client()
+
+    def __get_http2_client(self):
+        # Single connection, concurrent uploads are multiplexed as HTTP/2 streams
+        if self._http2_client is None:
+            self._http2_client = httpx.Client(
+                http2=True,
+                headers={"content-type": DEFAULT_CONTENT_TYPE},
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+                proxy=self._proxies.get("https"),
+            )
+        return self._http2_client
+
+    def __close_http2_client(self) -> None:
+        if self._http2_client is not None:
+            self._http2_client.close()
+            self._http2_client = None
+
+    def __mount_adapter(self) -> None:
+        # The ingest API is not idempotent: never resend a batch the server may
+        # have received, only retry failed connects and the listed statuses
+        retries = Retry(
+            total=DEFAULT_MAX_RETRIES,
+            read=0,
+            other=0,
+            backoff_factor=DEFAULT_RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self._max_parallel, max_retries=retries
+        )
+
+        previous = self._session.adapters.get("https://")
+        self._session.mount("https://", adapter)
+        if previous is not None:
+            previous.close()
+
     def __get_xmsdate_str(self, x_ms_date: datetime.datetime) -> str:
-        return x_ms_date.strftime("%a, %d %b %Y %H:%M:%S GMT")
+        # Naive datetimes are taken as UTC
+        if x_ms_date.tzinfo is None:
+            x_ms_date = x_ms_date.replace(tzinfo=datetime.timezone.utc)
+        return formatdate(x_ms_date.timestamp(), usegmt=True)
+
+    def __get_xmsdate_now(self) -> str:
+        # Only format the current date again once the second has changed
+        now = time.time()
+        second = int(now)
+        cached_second, x_ms_date_str = self._xmsdate_cache
+        if second != cached_second:
+            x_ms_date_str = formatdate(now, usegmt=True)
+            self._xmsdate_cache = (second, x_ms_date_str)
+        return x_ms_date_str
 
     def __build_authorization_headers(
         self,
         content_length: int,
         log_type: str,
-        x_ms_date: datetime.datetime,
+        x_ms_date: Union[datetime.datetime, str, None] = None,
     ) -> dict:
         """Builds authorization header as Data Collector API requirement
 
         Args:
-            content_length (int): string length of data to be uploaded
+            content_length (int): byte length of the uncompressed JSON body
             log_type (str): destination table name
-            x_ms_date (datetime): datetime. Default is UTC now
+            x_ms_date (datetime | str): datetime, or an already formatted
+                RFC 1123 date string. Default is UTC now
         Returns:
-            dict: headers with authorization signature
+            dict: per request headers with authorization signature
         """
 
         headers = {}
 
-        x_ms_date_str = self.__get_xmsdate_str(x_ms_date)
-        x_headers = "x-ms-date:" + x_ms_date_str
-
-        string_to_hash = f"POST\n{content_length}\n{DEFAULT_CONTENT_TYPE}\n{x_headers}\n{DEFAULT_RESOURCE}"
-
-        bytes_to_hash = bytes(string_to_hash, encoding="utf-8")
-        decoded_key = base64.b64decode(self.shared_key)
-        encoded_hash = base64.b64encode(
-            hmac.new(decoded_key, bytes_to_hash, digestmod=hashlib.sha256).digest()
-        ).decode()
-        authorization = f"SharedKey {self.customer_id}:{encoded_hash}"
-
-        headers["content-type"] = DEFAULT_CONTENT_TYPE
-        headers["Authorization"] = authorization
-        headers["Log-Type"] = log_type
+        if x_ms_date is None:
+            x_ms_date_str = self.__get_xmsdate_now()
+        elif isinstance(x_ms_date, str):
+            x_ms_date_str = x_ms_date
+        else:
+            x_ms_date_str = self.__get_xmsdate_str(x_ms_date)
+
+        headers["Authorization"] = self.__sign_cached(content_length, x_ms_date_str)
+        log_type_bytes = self._log_type_cache.get(log_type)
+        if log_type_bytes is None:
+            log_type_bytes = self._log_type_cache[log_type] = log_type.encode("ascii")
+        headers["Log-Type"] = log_type_bytes
         headers["x-ms-date"] = x_ms_date_str
 
         return headers
 
-    def __batch(self, data: list) -> list:
+    def __batch(
+        self, data: list, max_bytes_per_request: Optional[int] = None
+    ) -> Iterator[Tuple[int, bytes]]:
         """Divide rows into batches to ensure total request size stays below the 30MB limit.
+        Batches are built one at a time as they are consumed.
 
         Args:
             data (list): data to be divided into batches
+            max_bytes_per_request (int): maximum body size. Default is max_batch_size
 
-        Returns:
-            list: list of batched rows (list of lists)
+        Yields:
+            tuple: number of rows and JSON array body of each batch
         """
-        batches: list = []
-        tmp: list = []
-        batch_size: int = 0
-
-        for row in data:
-            row_size = sys.getsizeof(str(row))
-            if batch_size + row_size <= self._max_batch_size:
-                tmp.append(row)
-                batch_size += row_size
-            else:
-                batches.append(tmp)
-                tmp = [row]
-                batch_size = row_size
-
-        if batch_size:
-            batches.append(tmp)
+        if max_bytes_per_request is None:
+            max_bytes_per_request = self._max_batch_size
+
+        if not data:
+            return
+
+        # Common case: everything fits in a single request
+        encoded = _dumps(data)
+        if len(encoded) <= max_bytes_per_request:
+            yield len(data), encoded
+            return
+        # Too large for one request: release it before encoding row by row
+        del encoded
+
+        # A JSON array body is the rows, one comma after each but the last, and
+        # the two brackets, so each row counts its comma and the limit drops by one.
+        # Only the sizes are kept, rows are encoded again when their batch is built
+        boundaries = _find_boundaries(
+            [len(_dumps(row)) + 1 for row in data], max_bytes_per_request - 1
+        )
 
-        return batches
+        for start, end in zip(boundaries, boundaries[1:]):
+            rows = [_dumps(row) for row in data[start:end]]
+            yield end - start, b"[" + b",".join(rows) + b"]"
 
     @property
     def timeout(self) -> int:
@@ -132,9 +441,9 @@ class DataCollectorClient:
 
     @property
     def max_batch_size(self) -> int:
-        """Sets maximum data batch size based on string length. Default
-        is 29000000 to allow some overhead for the request headers while
-        keeping the total post size below 30MB.
+        """Sets maximum data batch size in bytes of the encoded JSON body.
+        Default is 29000000 to allow some overhead for the request headers
+        while keeping the total post size below 30MB.
 
         Returns:
             int: batch size
@@ -145,6 +454,56 @@ class DataCollectorClient:
     def max_batch_size(self, value: int):
         self._max_batch_size = value
 
+    @property
+    def max_parallel(self) -> int:
+        """Sets maximum number of batches uploaded concurrently. Default is 4.
+
+        Returns:
+            int: number of concurrent uploads
+        """
+        return self._max_parallel
+
+    @max_parallel.setter
+    def max_parallel(self, value: int):
+        self._max_parallel = value
+        self.__mount_adapter()
+
+    @property
+    def compress(self) -> bool:
+        """Sets gzip compression of the request body. Default is to post
+        uncompressed JSON. Batch size is still measured on the uncompressed body.
+
+        Returns:
+            bool: compression enabled
+        """
+        return self._compress
+
+    @compress.setter
+    def compress(self, value: bool):
+        self._compress = value
+
+    @property
+    def http2(self) -> bool:
+        """Sets uploading over a single multiplexed HTTP/2 connection using
+        httpx. Requires the http2 extra. Default is HTTP/1.1 using requests.
+
+        The HTTP/1.1 retry policy does not apply on this path: failed requests
+        are not retried, connection errors are raised as httpx exceptions, and
+        only the "https" entry of proxies is used.
+
+        Returns:
+            bool: HTTP/2 enabled
+        """
+        return self._http2
+
+    @http2.setter
+    def http2(self, value: bool):
+        if value and httpx is None:
+            raise ImportError(
+                "HTTP/2 requires httpx, install azure-data-collector[http2]"
+            )
+        self._http2 = value
+
     @property
     def proxies(self) -> dict:
         """Sets API call via proxy. Default is to not use any proxy.
@@ -157,6 +516,61 @@ class DataCollectorClient:
     @proxies.setter
     def proxies(self, value: Dict[str, str]):
         self._proxies = value
+        self._session.proxies = value
+        self.__close_http2_client()
+
+    def __upload(self, data_batch: bytes, log_type: str, failed: Event) -> None:
+        """Sign and post a single batch, unless another batch has already failed
+
+        Args:
+            data_batch (bytes): JSON array body
+            log_type (str): destination table name
+            failed (Event): set once any batch of the same post_data call fails
+        """
+        if failed.is_set():
+            return
+
+        try:
+            self.__post(data_batch, log_type)
+        except Exception:
+            failed.set()
+            raise
+
+    def __post(self, data_batch: bytes, log_type: str) -> None:
+        """Sign and post a single batch
+
+        Args:
+            data_batch (bytes): JSON array body
+            log_type (str): destination table name
+        """
+        headers = self.__build_authorization_headers(
+            content_length=len(data_batch), log_type=log_type
+        )
+
+        # Signature covers the uncompressed content length
+        if self.compress:
+            data_batch = gzip.compress(data_batch, compresslevel=DEFAULT_COMPRESS_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+
+        if self.http2:
+            response = self.__get_http2_client().post(
+                url=self.request_uri,
+                content=data_batch,
+                headers=headers,
+                timeout=self.timeout,
+            )
+        else:
+            response = self._session.post(
+                data=data_batch,
+                url=self.request_uri,
+                headers=headers,
+                timeout=self.timeout,
+            )
+
+        if response.status_code != 200:
+            raise DataCollectorError(
+                f"Error uploading, status code: {response.status_code}. {response.text}"
+            )
 
     def post_data(self, data: list, log_type: str) -> list[int]:
         """Post data to the Data Collector API
@@ -169,33 +583,29 @@ class DataCollectorClient:
             list: metric with number of rows uploaded per batch
         """
 
-        batched_data = self.__batch(data)
-        metric = []
-
-        with Session() as session:
+        if self.http2:
+            self.__get_http2_client()
 
-            session.proxies = self.proxies
-            for batch in batched_data:
-
-                data_batch = json.dumps(batch)
+        metric = []
+        failed = Event()
 
-                headers = self.__build_authorization_headers(
-                    content_length=len(data_batch),
-                    log_type=log_type,
-                    x_ms_date=datetime.datetime.utcnow(),
-                )
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
 
-                session.headers = headers
+            # Build batches as uploads free up, so at most max_parallel bodies
+            # are held in memory
+            pending: Set[Future] = set()
+            for row_count, data_batch in self.__batch(data):
+                if len(pending) >= self.max_parallel:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
 
-                response = session.post(
-                    data=data_batch, url=self.request_uri, timeout=self.timeout
+                pending.add(
+                    executor.submit(self.__upload, data_batch, log_type, failed)
                 )
+                metric.append(row_count)
 
-                if response.status_code != 200:
-                    raise DataCollectorError(
-                        f"Error uploading, status code: {response.status_code}. {response.text}"
-                    )
-
-                metric.append(len(batch))
+            for future in as_completed(pending):
+                future.result()
 
         return metric
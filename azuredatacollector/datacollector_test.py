@@ -1,9 +1,25 @@
 """Tests"""
-from datetime import datetime
+import builtins
+import gc
+import gzip
+import importlib.util
+import json
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
 
 import pytest
+import requests
 
-from azuredatacollector.datacollector import DataCollectorClient
+from azuredatacollector import datacollector
+from azuredatacollector.datacollector import DataCollectorClient, DataCollectorError
 
 
 @pytest.fixture
@@ -12,17 +28,68 @@ def test_client():
     return DataCollectorClient("customer_id", "c2hhcmVkX2tleQ==")
 
 
+def batch(client, data, max_bytes_per_request) -> list:
+    """Collects the batches yielded by the client's __batch"""
+    return list(
+        client._DataCollectorClient__batch(
+            data=data, max_bytes_per_request=max_bytes_per_request
+        )
+    )
+
+
+@pytest.fixture
+def stub_post(test_client, monkeypatch):
+    """Replaces the HTTP post with a stub answering status_code, returns the
+    keyword arguments of every post"""
+
+    def stub(status_code: int = 200, http2: bool = False) -> list:
+        calls = []
+
+        def post(**kwargs):
+            calls.append(kwargs)
+            return SimpleNamespace(status_code=status_code, text="Response text")
+
+        if http2:
+            monkeypatch.setattr(
+                test_client,
+                "_DataCollectorClient__get_http2_client",
+                lambda: SimpleNamespace(post=post),
+            )
+            # Set directly so the test does not need httpx installed
+            monkeypatch.setattr(test_client, "_http2", True)
+        else:
+            monkeypatch.setattr(test_client._session, "post", post)
+        return calls
+
+    return stub
+
+
 def test_build_authorization_header(test_client) -> None:
 
     headers = test_client._DataCollectorClient__build_authorization_headers(
         content_length=1, log_type="TestTable", x_ms_date=datetime(2000, 1, 1, 1, 1, 1)
     )
 
-    assert headers.get("content-type") == "application/json"
-    assert headers.get("Log-Type") == "TestTable"
+    assert "content-type" not in headers
+    assert headers.get("Log-Type") == b"TestTable"
+    assert (
+        headers.get("Authorization")
+        == b"SharedKey customer_id:p9rltWgAbXzQtX8iV4P1E95fvA3n7imvysp16fPUXKE="
+    )
+    assert headers.get("x-ms-date") == "Sat, 01 Jan 2000 01:01:01 GMT"
+
+
+def test_build_authorization_header_preformatted_date(test_client) -> None:
+
+    headers = test_client._DataCollectorClient__build_authorization_headers(
+        content_length=1,
+        log_type="TestTable",
+        x_ms_date="Sat, 01 Jan 2000 01:01:01 GMT",
+    )
+
     assert (
         headers.get("Authorization")
-        == "SharedKey customer_id:p9rltWgAbXzQtX8iV4P1E95fvA3n7imvysp16fPUXKE="
+        == b"SharedKey customer_id:p9rltWgAbXzQtX8iV4P1E95fvA3n7imvysp16fPUXKE="
     )
     assert headers.get("x-ms-date") == "Sat, 01 Jan 2000 01:01:01 GMT"
 
@@ -30,19 +97,297 @@ def test_build_authorization_header(test_client) -> None:
 @pytest.mark.parametrize(
     "test_data, test_max_bytes, expected",
     [
+        (
+            [{"col": "data"}, {"col": "data"}, {"col": "data"}],
+            30,
+            [
+                (1, b'[{"col":"data"}]'),
+                (1, b'[{"col":"data"}]'),
+                (1, b'[{"col":"data"}]'),
+            ],
+        ),
         (
             [{"col": "data"}, {"col": "data"}, {"col": "data"}],
             33,
-            [[{"col": "data"}], [{"col": "data"}], [{"col": "data"}]],
+            [(2, b'[{"col":"data"},{"col":"data"}]'), (1, b'[{"col":"data"}]')],
         ),
-        ([{"col": "data"}], 0, [[{"col": "data"}]]),
-        ([{"col": "data"}], 3000, [[{"col": "data"}]]),
+        ([{"col": "data"}], 0, [(1, b'[{"col":"data"}]')]),
+        ([{"col": "data"}], 3000, [(1, b'[{"col":"data"}]')]),
+        ([], 3000, []),
     ],
 )
 def test_batch(test_client, test_data, test_max_bytes, expected) -> None:
-    assert (
-        test_client._DataCollectorClient__batch(
-            data=test_data, max_bytes_per_request=test_max_bytes
-        )
-        == expected
+    assert batch(test_client, test_data, test_max_bytes) == expected
+
+
+def test_batch_varying_row_sizes(test_client) -> None:
+    test_data = [{"col": "x" * (i * 7 % 50)} for i in range(200)]
+
+    batches = batch(test_client, test_data, 300)
+
+    assert all(len(body) <= 300 for _, body in batches)
+    assert all(len(json.loads(body)) == row_count for row_count, body in batches)
+    assert [row for _, body in batches for row in json.loads(body)] == test_data
+
+
+@pytest.mark.parametrize(
+    "find_boundaries",
+    [
+        datacollector._find_boundaries_py,
+        pytest.param(
+            datacollector._find_boundaries_np,
+            marks=pytest.mark.skipif(datacollector.np is None, reason="no numpy"),
+        ),
+        pytest.param(
+            datacollector._find_boundaries_numba,
+            marks=pytest.mark.skipif(
+                importlib.util.find_spec("numba") is None, reason="no numba"
+            ),
+        ),
+    ],
+)
+@pytest.mark.parametrize(
+    "sizes, max_size, expected",
+    [
+        ([], 10, [0]),
+        ([3, 3, 3], 10, [0, 3]),
+        ([3, 3, 3], 6, [0, 2, 3]),
+        ([3, 20, 3], 6, [0, 1, 2, 3]),
+        ([3, 3, 3], 0, [0, 1, 2, 3]),
+    ],
+)
+def test_find_boundaries(find_boundaries, sizes, max_size, expected) -> None:
+    assert find_boundaries(sizes, max_size) == expected
+
+
+def test_post_data_metric(test_client, stub_post) -> None:
+    posted = stub_post()
+    test_client.max_batch_size = 33
+
+    metric = test_client.post_data([{"col": "data"}] * 5, "TestTable")
+
+    assert metric == [2, 2, 1]
+    assert sorted(len(json.loads(call["data"])) for call in posted) == [1, 2, 2]
+
+
+def test_post_data_error_stops_upload(test_client, stub_post) -> None:
+    posted = stub_post(status_code=500)
+    test_client.max_batch_size = 33
+    test_client.max_parallel = 1
+
+    with pytest.raises(DataCollectorError, match="status code: 500"):
+        test_client.post_data([{"col": "data"}] * 5, "TestTable")
+
+    assert [call["data"] for call in posted] == [b'[{"col":"data"},{"col":"data"}]']
+
+
+def test_post_data_compress(test_client, stub_post) -> None:
+    posted = stub_post()
+    test_client.compress = True
+
+    test_client.post_data([{"col": "data"}, {"col": "data"}], "TestTable")
+
+    body, headers = posted[0]["data"], posted[0]["headers"]
+    uncompressed = gzip.decompress(body)
+    expected = test_client._DataCollectorClient__build_authorization_headers(
+        content_length=len(uncompressed),
+        log_type="TestTable",
+        x_ms_date=headers["x-ms-date"],
+    )
+
+    assert headers["Content-Encoding"] == "gzip"
+    assert uncompressed == b'[{"col":"data"},{"col":"data"}]'
+    assert headers["Authorization"] == expected["Authorization"]
+
+
+@pytest.fixture
+def local_server(test_client):
+    """Local HTTP server behind the client's retrying adapter. Each POST is
+    answered with the next queued status, or left unanswered past the client
+    timeout for None."""
+    statuses = []
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(self.rfile.read(int(self.headers["Content-Length"])))
+            status = statuses.pop(0)
+            if status is None:
+                time.sleep(0.5)
+                status = 200
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    session = test_client._session
+    session.mount("http://", session.get_adapter("https://example.com"))
+    test_client.request_uri = f"http://127.0.0.1:{server.server_port}/api/logs"
+
+    yield SimpleNamespace(statuses=statuses, received=received)
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_retry_on_throttling(test_client, local_server) -> None:
+    local_server.statuses.extend([503, 200])
+
+    assert test_client.post_data([{"col": "data"}], "TestTable") == [1]
+    assert len(local_server.received) == 2
+
+
+def test_no_retry_on_server_error(test_client, local_server) -> None:
+    local_server.statuses.extend([500, 200])
+
+    with pytest.raises(DataCollectorError, match="status code: 500"):
+        test_client.post_data([{"col": "data"}], "TestTable")
+    assert len(local_server.received) == 1
+
+
+def test_no_retry_on_read_timeout(test_client, local_server) -> None:
+    local_server.statuses.extend([None, 200, 200, 200])
+    test_client.timeout = 0.1
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        test_client.post_data([{"col": "data"}], "TestTable")
+    assert len(local_server.received) == 1
+
+
+def test_max_parallel_closes_replaced_adapter(test_client, monkeypatch) -> None:
+    previous = test_client._session.get_adapter("https://example.com")
+    closed = []
+    monkeypatch.setattr(previous, "close", lambda: closed.append(True))
+
+    test_client.max_parallel = 8
+
+    assert closed == [True]
+    assert test_client._session.get_adapter("https://example.com") is not previous
+
+
+FALLBACK_ROWS = [
+    {"col": "data", 1: "int key"},
+    {"col": datetime(2020, 1, 1), "other": datetime(2020, 1, 1, 1, 2, 3, 456)},
+    {"col": datetime(2020, 1, 1, tzinfo=timezone(timedelta(hours=2)))},
+    {"col": uuid.UUID("12345678-1234-5678-1234-567812345678"), "text": "\u00e9\u4e2d"},
+]
+
+
+def test_json_fallback_matches_orjson(test_client, monkeypatch) -> None:
+    orjson = pytest.importorskip("orjson")
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+
+    for row in FALLBACK_ROWS:
+        assert datacollector._json_dumps(row) == orjson.dumps(row, option=option)
+
+    expected = batch(test_client, FALLBACK_ROWS, 150)
+    monkeypatch.setattr(datacollector, "_dumps", datacollector._json_dumps)
+
+    assert batch(test_client, FALLBACK_ROWS, 150) == expected
+    assert len(expected) > 1
+    assert all(len(body) <= 150 for row_count, body in expected if row_count > 1)
+
+
+@pytest.mark.parametrize(
+    "dumps", [datacollector._dumps, datacollector._json_dumps], ids=["dumps", "json"]
+)
+def test_dumps_integers_beyond_64_bits(test_client, monkeypatch, dumps) -> None:
+    test_data = [{"id": 2**64}, {"id": -(2**63) - 1}, {"id": 1}]
+    monkeypatch.setattr(datacollector, "_dumps", dumps)
+
+    assert dumps(test_data[0]) == b'{"id":18446744073709551616}'
+    assert batch(test_client, test_data, 62) == [
+        (2, b'[{"id":18446744073709551616},{"id":-9223372036854775809}]'),
+        (1, b'[{"id":1}]'),
+    ]
+
+
+def test_post_data_http2(test_client, stub_post) -> None:
+    posted = stub_post(http2=True)
+    test_client.timeout = 10
+
+    assert test_client.post_data([{"col": "data"}], "TestTable") == [1]
+
+    assert len(posted) == 1
+    assert posted[0]["url"] == test_client.request_uri
+    assert posted[0]["content"] == b'[{"col":"data"}]'
+    assert posted[0]["timeout"] == 10
+    assert posted[0]["headers"]["Log-Type"] == b"TestTable"
+    assert posted[0]["headers"]["Authorization"].startswith(b"SharedKey customer_id:")
+    assert "data" not in posted[0]
+
+
+@pytest.mark.skipif(datacollector.np is None, reason="no numpy")
+def test_find_boundaries_numba_import_error(monkeypatch) -> None:
+    real_import = builtins.__import__
+
+    def failing_import(name, *args, **kwargs):
+        if name == "numba":
+            raise ImportError("Numba needs NumPy 2.0 or less")
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", failing_import)
+    monkeypatch.setattr(datacollector, "_find_boundaries_impl", None)
+    monkeypatch.setattr(datacollector, "_compiled_kernel", None)
+
+    assert datacollector._find_boundaries([3, 3, 3], 6) == [0, 2, 3]
+    assert datacollector._find_boundaries([3, 3, 3], 6) == [0, 2, 3]
+    assert datacollector._find_boundaries_impl is datacollector._find_boundaries_np
+
+
+def test_import_does_not_load_numba() -> None:
+    code = "import sys, azuredatacollector.datacollector; print('numba' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == "False"
+
+
+def test_client_freed_without_cyclic_gc() -> None:
+    client = DataCollectorClient("customer_id", "c2hhcmVkX2tleQ==")
+    client._DataCollectorClient__build_authorization_headers(1, "TestTable")
+    ref = weakref.ref(client)
+
+    gc.disable()
+    try:
+        del client
+        assert ref() is None
+    finally:
+        gc.enable()
+
+
+def traced_peak(func) -> int:
+    """Peak memory traced while running func"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_post_data_peak_memory(test_client, monkeypatch) -> None:
+    test_data = [{"col": "x" * 200, "row": i} for i in range(20000)]
+    monkeypatch.setattr(
+        test_client._session,
+        "post",
+        lambda **kwargs: SimpleNamespace(status_code=200, text=""),
     )
+    test_client.max_batch_size = 200000
+    test_client.max_parallel = 2
+    # Load and compile the boundary search outside the traced section
+    datacollector._find_boundaries([1], 1)
+
+    encode_peak = traced_peak(lambda: datacollector._dumps(test_data))
+    peak = traced_peak(lambda: test_client.post_data(test_data, "TestTable"))
+
+    # Beyond the single-shot size check encoding the whole payload, only the
+    # batches being uploaded plus the one being built may be held
+    assert peak < encode_peak + 3 * test_client.max_batch_size
@@ -21,11 +21,19 @@ REQUIRES_PYTHON = ">=3.9.0"
 VERSION = "0.1.1"
 
 # What packages are required for this module to be executed?
-REQUIRED = ["requests"]
+REQUIRED = [
+    "orjson; platform_python_implementation == 'CPython'",
+    "requests",
+    "urllib3>=1.26",
+]
 
 # What packages are optional?
 EXTRAS = {
     # 'fancy feature': ['django'],
+    "isal": ["isal"],
+    "numpy": ["numpy"],
+    "numba": ["numba"],
+    "http2": ["httpx[http2]>=0.26"],
 }
 
 # The rest you shouldn't have to touch too much :)